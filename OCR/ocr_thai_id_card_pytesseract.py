@@ -36,6 +36,12 @@ except Exception as e:
     print(f"Error loading models: {e}")
     CARD_DETECTOR, TEXT_DETECTOR = None, None
 
+# --- OCR Field Constants ---
+TH_LABELS = frozenset({'prefix_name_th', 'first_name_th', 'last_name_th', 'date_of_birth_th', 'date_of_expity_th', 'religion'})
+EN_LABELS = frozenset({'prefix_name_en', 'first_name_en', 'last_name_en', 'date_of_birth_en', 'date_of_expity_en'})
+_NEWLINE = re.compile(r'[\n\x0c]')
+_ID_CLEAN = re.compile(r'[^\d\s]')
+
 # --- Helper Functions for OCR Pipeline ---
 
 def save_plotted_image(results, output_path):
@@ -71,12 +77,14 @@ def detect_text_fields(text_detector_model, cropped_card_img):
     if cropped_card_img is None: return [], None
     results = text_detector_model(cropped_card_img, conf=0.25, iou=0.25)
     boxes_data = results[0].boxes
+    # Move the boxes to the host once instead of syncing with the device for every box.
+    xyxy = boxes_data.xyxy.cpu().numpy().astype(int)
+    cls = boxes_data.cls.cpu().numpy().astype(int)
+    conf = boxes_data.conf.cpu().numpy()
     best_detections = {}
-    for i in range(len(boxes_data)):
-        box = boxes_data.xyxy[i].cpu().numpy().astype(int)
-        class_id = int(boxes_data.cls[i].cpu().numpy())
+    for box, class_id, confidence in zip(xyxy, cls, conf):
         label = text_detector_model.names[class_id]
-        confidence = float(boxes_data.conf[i].cpu().numpy())
+        confidence = float(confidence)
         if label not in best_detections or confidence > best_detections[label]['confidence']:
             best_detections[label] = {'box': box, 'label': label, 'confidence': confidence}
     detections = sorted(list(best_detections.values()), key=lambda d: (d['box'][1], d['box'][0]))
@@ -86,16 +94,14 @@ def detect_text_fields(text_detector_model, cropped_card_img):
 def read_text_from_fields(cropped_card_img, text_fields):
     """Uses pytesseract to read text from each detected field."""
     extracted_data = {}
-    th_labels = ['prefix_name_th', 'first_name_th', 'last_name_th', 'date_of_birth_th', 'date_of_expity_th', 'religion']
-    en_labels = ['prefix_name_en', 'first_name_en', 'last_name_en', 'date_of_birth_en', 'date_of_expity_en']
     for field in text_fields:
         box, label = field['box'], field['label']
         text_region = cropped_card_img[box[1]:box[3], box[0]:box[2]]
         if text_region.size > 0:
             # Select the correct language for Tesseract
-            if label in th_labels:
+            if label in TH_LABELS:
                 lang = 'tha'
-            elif label in en_labels:
+            elif label in EN_LABELS:
                 lang = 'eng'
             else:
                 # Use both languages for fields like ID number, dates, etc.
@@ -108,7 +114,7 @@ def read_text_from_fields(cropped_card_img, text_fields):
             
             if extracted_text:
                 # Clean up common OCR errors like newline characters
-                cleaned_text = re.sub(r'[\n\x0c]', '', extracted_text)
+                cleaned_text = _NEWLINE.sub('', extracted_text)
                 print(f"  Label '{label}': Read text -> '{cleaned_text}'")
                 extracted_data[label] = cleaned_text
     return extracted_data
@@ -117,7 +123,7 @@ def map_entities(raw_text_data):
     """Cleans and structures the raw OCR data."""
     entities = {}
     if 'id_card' in raw_text_data:
-        entities['id_card'] = re.sub(r'[^\d\s]', '', raw_text_data['id_card']).strip()
+        entities['id_card'] = _ID_CLEAN.sub('', raw_text_data['id_card']).strip()
     if 'en_name' in raw_text_data:
         parts = raw_text_data['en_name'].split()
         if len(parts) >= 3: